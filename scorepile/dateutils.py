@@ -4,24 +4,70 @@ import pytz
 # All timestamps on Isotropic are in Pacific time.
 # During the DST transition when this is ambiguous, the timestamps are
 # ambiguous too. So let's standardize on using PT throughout scorepile.
+#
+# The database stores naive timestamps in UTC. Use `to_db` to convert a
+# datetime for storing or querying, and `to_pt` to convert it back.
 PT = pytz.timezone('America/Los_Angeles')
 UTC = pytz.timezone('UTC')
 
 
-def midnight_before(dt):
-    return datetime(dt.year, dt.month, dt.day, tzinfo=dt.tzinfo)
+def to_pt(dt):
+    "Convert a datetime to PT. Naive datetimes from the database are in UTC."
+    if dt.tzinfo is None:
+        dt = UTC.localize(dt)
+    return dt.astimezone(PT)
 
 
-def midnight_after(dt):
-    return midnight_before(dt) + timedelta(days=1)
+def to_db(dt):
+    "Convert a datetime to a naive UTC datetime, as stored in the database."
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(UTC).replace(tzinfo=None)
 
 
-def friendly_date(dt):
-    if dt.tzinfo is None:
-        dt = UTC.localize(dt).astimezone(PT)
-    now = datetime.now(PT)
-    diff = dt - midnight_before(now)
-    days = diff.days
+def pt_day(dt):
+    """
+    Get the date in Pacific time when something happened. Naive datetimes
+    from the database are in UTC.
+    """
+    if not isinstance(dt, datetime):
+        return dt
+    return to_pt(dt).date()
+
+
+def day_key(dt):
+    """
+    Get the PT date of a datetime or date as a 'YYYY/MM/DD' string. This is
+    the form used in URLs, and it's the key for anything that's per-day,
+    such as cached pages.
+    """
+    return pt_day(dt).strftime('%Y/%m/%d')
+
+
+def day_bounds(dt):
+    """
+    Get the start and end of the PT day containing a datetime, as naive UTC
+    datetimes for querying the database.
+
+    A PT day isn't always 24 hours long, so the end is found by localizing
+    the next midnight, not by adding a day.
+    """
+    day = pt_day(dt)
+    next_day = day + timedelta(days=1)
+    start = PT.localize(datetime(day.year, day.month, day.day))
+    end = PT.localize(datetime(next_day.year, next_day.month, next_day.day))
+    return to_db(start), to_db(end)
+
+
+def friendly_date(dt, now=None):
+    """
+    Describe a date relative to `now`. When describing many dates at once,
+    pass the same `now` to all of them, so they agree on what day it is.
+    """
+    dt = to_pt(dt)
+    if now is None:
+        now = datetime.now(PT)
+    days = (dt.date() - pt_day(now)).days
 
     if days >= 0:
         return 'today'
@@ -31,26 +77,24 @@ def friendly_date(dt):
         # express it as the day of the week
         return dt.strftime('%A')
     else:
-        return full_date(dt)
+        return full_date(dt, now)
 
 
 def friendly_time(dt):
-    if dt.tzinfo is None:
-        dt = UTC.localize(dt).astimezone(PT)
+    dt = to_pt(dt)
 
     time = datetime.strftime(dt, '%I:%M %p').lstrip('0')
     tz = dt.tzname()
     return "{} ({})".format(time, tz)
 
 
-def full_date(dt):
-    if dt.tzinfo is None:
-        dt = UTC.localize(dt)
-    now = datetime.now(PT)
-    
+def full_date(dt, now=None):
+    dt = to_pt(dt)
+    if now is None:
+        now = datetime.now(PT)
+
     date_in_year = dt.strftime('%A, %B %d').replace(' 0', ' ')
-    if dt.year == now.year:
+    if dt.year == pt_day(now).year:
         return date_in_year
     else:
         return '{}, {}'.format(date_in_year, dt.year)
-
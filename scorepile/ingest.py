@@ -0,0 +1,387 @@
+__package__ = 'scorepile'
+import scorepile
+import json
+import logging
+import os
+import queue
+import signal
+import tarfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy.exc import OperationalError, InterfaceError
+from .db import Session
+from .parser import GameParser
+from .models import Game, IngestedFile
+from .dateutils import day_key
+
+LOG = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ('.tar.bz2', '.tar.gz', '.tgz')
+
+# Errors that mean the database is unavailable, not that a file is bad.
+# Files that fail this way are retried instead of being marked as failed.
+DB_UNAVAILABLE = (OperationalError, InterfaceError)
+
+# How long to wait before retrying a batch after an error, in seconds. The
+# wait doubles after each failure, up to the maximum.
+RETRY_MIN = 5
+RETRY_MAX = 300
+
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_EXTENSIONS)
+
+
+def extract_archive(path):
+    """
+    Unpack an archive of game logs next to it. The extracted logs will be
+    found by the next scan of the directory.
+    """
+    dest = os.path.dirname(path)
+    with tarfile.open(path) as tar:
+        members = [member for member in tar.getmembers()
+                   if member.isfile() and not member.name.startswith('/')
+                   and '..' not in member.name.split('/')]
+        tar.extractall(dest, members=members)
+
+
+class IngestStats:
+    """
+    Counters describing how the ingest daemon is doing, which it writes out
+    as JSON after every batch.
+
+    The lag is how long the oldest file in the last batch waited between
+    being queued and being committed. (File modification times would be
+    useless here, because files unpacked from an old archive keep their
+    original times.)
+    """
+    def __init__(self, work_queue, path=None):
+        self.queue = work_queue
+        self.path = path
+        self.started = time.time()
+        self.ingested = 0
+        self.failed = 0
+        self.errors = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+        self.lag = 0.0
+
+    def record_batch(self, nfiles, nfailed, seconds, oldest_queued):
+        self.batches += 1
+        self.ingested += nfiles - nfailed
+        self.failed += nfailed
+        self.last_batch_size = nfiles
+        self.last_batch_seconds = seconds
+        if oldest_queued is not None:
+            self.lag = time.time() - oldest_queued
+        self.write()
+
+    def record_error(self):
+        self.errors += 1
+        self.write()
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        if self.last_batch_seconds > 0:
+            throughput = self.last_batch_size / self.last_batch_seconds
+        else:
+            throughput = 0.0
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_max': self.queue.maxsize,
+            'lag_seconds': round(self.lag, 1),
+            'throughput': round(throughput, 2),
+            'average_throughput': round(self.ingested / elapsed, 2),
+            'ingested': self.ingested,
+            'failed': self.failed,
+            'errors': self.errors,
+            'batches': self.batches,
+            'updated_at': datetime.now().isoformat()
+        }
+
+    def write(self):
+        stats = self.as_dict()
+        LOG.info("Ingest stats: {}".format(stats))
+        if self.path is not None:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as out:
+                json.dump(stats, out)
+            os.replace(tmp_path, self.path)
+
+
+class IngestDaemon:
+    """
+    Watches a directory for game logs and archives, and loads them into the
+    database as they show up.
+
+    The scanner polls the directory in one thread, and the loader runs in
+    another, connected by a queue of at most `queue_size` files. When the
+    database falls behind, the scanner waits for room in the queue instead of
+    filling up memory.
+
+    The loader commits up to `batch_size` files at a time, in the same
+    transaction as the checkpoints saying those files were ingested, so a
+    restart picks up exactly where it left off.
+
+    Files modified in the last `settle_time` seconds may still be being
+    written, so they're left for the next scan.
+
+    If the database goes away, the loader keeps retrying its batch with
+    increasing waits, and the scanner waits for the next poll. Neither one
+    gives up, and nothing is checkpointed until it has really been loaded.
+    """
+    def __init__(self, path, poll_interval=60, queue_size=1000,
+                 batch_size=100, batch_wait=5, settle_time=10,
+                 stats_path=None, invalidate=True):
+        self.path = path.rstrip('/')
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.invalidate = invalidate
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = IngestStats(self.queue, stats_path)
+        self.stopping = threading.Event()
+
+        # Files that are queued or being loaded, so that a scan in the
+        # meantime doesn't queue them again, mapped to when they were queued.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        # The modification time of each directory when we last scanned it.
+        # A directory that hasn't changed since then has nothing new in it.
+        self.dir_mtimes = {}
+
+    def run(self):
+        loader = threading.Thread(target=self.load_forever, name='loader')
+        loader.start()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.scan()
+                except Exception:
+                    # Directories that weren't finished will be scanned
+                    # again next time.
+                    LOG.exception("Scan failed; trying again in {} seconds"
+                                  .format(self.poll_interval))
+                self.stopping.wait(self.poll_interval)
+        finally:
+            self.stopping.set()
+            loader.join()
+
+    def stop(self, *args):
+        LOG.info("Stopping ingest")
+        self.stopping.set()
+
+    def scan(self):
+        dirs = [self.path]
+        while dirs:
+            dirpath = dirs.pop()
+            # Get the directory's modification time before listing it. A
+            # file that shows up after the listing changes the time again,
+            # so the next scan will look at this directory again.
+            mtime = os.stat(dirpath).st_mtime
+            entries = sorted(os.scandir(dirpath), key=lambda entry: entry.name)
+            dirs.extend(reversed([entry.path for entry in entries
+                                  if entry.is_dir()]))
+            if self.dir_mtimes.get(dirpath) == mtime:
+                continue
+            settled = time.time() - self.settle_time
+            candidates = []
+            unsettled = False
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if not (entry.name.endswith('.html') or
+                        is_archive(entry.name)):
+                    continue
+                if entry.stat().st_mtime > settled:
+                    unsettled = True
+                else:
+                    candidates.append(entry.path)
+            if self.queue_new(candidates) and not unsettled:
+                # Only remember the directory once everything in it is
+                # queued, so that an interrupted scan will look again.
+                self.dir_mtimes[dirpath] = mtime
+            if self.stopping.is_set():
+                return
+
+    def queue_new(self, paths, chunk_size=500):
+        """
+        Queue the paths that haven't been ingested yet. This blocks while the
+        queue is full. Returns False if we're stopping before it's done.
+        """
+        session = Session()
+        try:
+            for start in range(0, len(paths), chunk_size):
+                chunk = paths[start:start + chunk_size]
+                known = IngestedFile.known_paths(session, chunk)
+                for path in chunk:
+                    with self.pending_lock:
+                        if path in known or path in self.pending:
+                            continue
+                        self.pending[path] = time.time()
+                    if not self.put(path):
+                        return False
+        finally:
+            session.close()
+        return True
+
+    def put(self, path):
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(path, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def next_batch(self):
+        batch = []
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def load_forever(self):
+        # Files still in the queue when we stop have no checkpoint, so they'll
+        # be found again on the next run.
+        while not self.stopping.is_set():
+            batch = self.next_batch()
+            if batch:
+                self.load_with_retries(batch)
+                with self.pending_lock:
+                    for path in batch:
+                        self.pending.pop(path, None)
+
+    def load_with_retries(self, paths):
+        """
+        Load a batch of files, waiting and trying again for as long as it
+        fails. If we're stopped first, the files that weren't loaded have no
+        checkpoint, so they'll be found again on the next run.
+        """
+        delay = RETRY_MIN
+        while not self.stopping.is_set():
+            try:
+                self.load_batch(paths)
+                return
+            except Exception:
+                LOG.exception("Couldn't load batch; retrying in {} seconds"
+                              .format(delay))
+                self.stats.record_error()
+                self.stopping.wait(delay)
+                delay = min(delay * 2, RETRY_MAX)
+
+    def load_batch(self, paths):
+        """
+        Load some files and checkpoint them in one transaction.
+
+        If a file makes the batch fail, the files are loaded one at a time,
+        and the file that fails on its own is checkpointed as failed. If the
+        database is unavailable, the error is raised instead, so that the
+        batch can be retried.
+        """
+        start = time.time()
+        days = set()
+        iso_ids = set()
+        failed = 0
+
+        session = Session()
+        try:
+            # This might be a retry of a batch that was partly loaded one
+            # file at a time.
+            known = IngestedFile.known_paths(session, paths)
+            paths = [path for path in paths if path not in known]
+            if not paths:
+                return
+            try:
+                for path in paths:
+                    ok = self.load_file(session, path, days, iso_ids)
+                    if not ok:
+                        failed += 1
+                    session.add(IngestedFile(
+                        path=path, mtime=int(os.stat(path).st_mtime), ok=ok,
+                        ingested_at=datetime.utcnow()
+                    ))
+                session.commit()
+            except DB_UNAVAILABLE:
+                raise
+            except Exception:
+                # One bad file shouldn't lose the whole batch. Load them one
+                # at a time to find out which one it was.
+                LOG.exception("Batch failed; loading its files one at a time")
+                session.rollback()
+                if len(paths) > 1:
+                    for path in paths:
+                        self.load_batch([path])
+                    return
+                session.add(IngestedFile(path=paths[0], ok=False,
+                                         ingested_at=datetime.utcnow()))
+                session.commit()
+                failed = 1
+        finally:
+            session.close()
+
+        if self.invalidate and (days or iso_ids):
+            from scorepile.web import invalidate_pages
+            invalidate_pages(days, iso_ids)
+        with self.pending_lock:
+            queued = [self.pending[path] for path in paths
+                      if path in self.pending]
+        self.stats.record_batch(len(paths), failed, time.time() - start,
+                                min(queued) if queued else None)
+
+    def load_file(self, session, path, days, iso_ids):
+        """
+        Load one file into the session, without committing. Adds the days
+        and players it affects to `days` and `iso_ids`, and returns whether
+        it worked.
+        """
+        if is_archive(path):
+            extract_archive(path)
+            return True
+        parsed = GameParser.parse_file(path)
+        if parsed is None:
+            LOG.warn("Couldn't parse {}".format(path))
+            return False
+        Game.create(session, parsed, commit=False)
+        days.add(day_key(parsed['timestamp']))
+        for player in parsed['players'].values():
+            if player['iso_id']:
+                iso_ids.add(player['iso_id'])
+        return True
+
+
+# This file can be run as a script from the command line.
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Watch a directory and load new game logs as they appear.'
+    )
+    parser.add_argument('dir')
+    parser.add_argument('--poll', type=float, default=60,
+                        help='seconds between scans of the directory')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='most files to have waiting at once')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='most files to load in one transaction')
+    parser.add_argument('--settle', type=float, default=10,
+                        help='seconds to wait for new files to be written')
+    parser.add_argument('--stats', default=None,
+                        help='file to write ingest statistics to, as JSON')
+    args = parser.parse_args()
+    daemon = IngestDaemon(args.dir, poll_interval=args.poll,
+                          queue_size=args.queue_size,
+                          batch_size=args.batch_size,
+                          settle_time=args.settle, stats_path=args.stats)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
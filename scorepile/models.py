@@ -1,17 +1,33 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, joinedload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import (Column, String, Integer, Boolean, DateTime,
-                        ForeignKey, desc)
+from sqlalchemy import (Column, String, Integer, Boolean, Date, DateTime,
+                        ForeignKey, ForeignKeyConstraint, UniqueConstraint,
+                        Index, and_, case, desc, func, or_, text, tuple_)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import json
 import logging
+from datetime import datetime, timedelta
 from scorepile import dateutils
+from scorepile.parser import GameParser
 from jinja2 import Template
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 Base = declarative_base()
 
+# The tables that are partitioned by month, on the game's timestamp. Tables
+# that refer to a game refer to it by (id, timestamp), because a key on a
+# partitioned table has to include the column it's partitioned on.
+PARTITIONED_TABLES = ['games', 'game_players']
+
+
+def game_reference(id_column, timestamp_column):
+    "A foreign key to a game, which follows the game if its timestamp changes."
+    return ForeignKeyConstraint([id_column, timestamp_column],
+                                ['games.id', 'games.timestamp'],
+                                onupdate='CASCADE')
+
 
 class DataMixin:
     """
@@ -92,19 +108,60 @@ class Player(Base, DataMixin):
         except NoResultFound:
             return None
 
-    def played_games(self, session, day=None, limit=1000):
-        played = (session.query(GamePlayer)
-                         .join(GamePlayer.game)
-                         .filter(GamePlayer.player == self)
+    def played_games_query(self, session, day=None, limit=1000):
+        """
+        Get a query for the Games this player has played, most recent first.
+
+        This returns the query instead of a list, so that callers such as the
+        web pages can stream through the results without loading them all.
+        """
+        played = (session.query(Game)
+                         .join(Game.players)
+                         .filter(GamePlayer.player_id == self.id)
                          .filter(Game.nplayers >= 2)
                          .order_by(desc(Game.timestamp)))
         if day is not None:
-            day_start = dateutils.midnight_before(day)
-            day_end = dateutils.midnight_after(day)
+            day_start, day_end = dateutils.day_bounds(day)
             played = (played.filter(Game.timestamp >= day_start)
                             .filter(Game.timestamp < day_end))
-        played = played.limit(limit)
-        return [item.game for item in played]
+        return played.limit(limit)
+
+    def played_games(self, session, day=None, limit=1000):
+        return self.played_games_query(session, day, limit).all()
+
+    @staticmethod
+    def most_active(session, since, limit):
+        """
+        Get the registered players who have played the most games since a
+        given time, most active first.
+        """
+        counts = (session.query(GamePlayer.player_id,
+                                func.count(GamePlayer.id).label('ngames'))
+                         .join(GamePlayer.game)
+                         .filter(GamePlayer.player_id != None)
+                         .filter(Game.nplayers >= 2)
+                         .filter(Game.timestamp >= dateutils.to_db(since))
+                         .group_by(GamePlayer.player_id)
+                         .order_by(desc('ngames'))
+                         .limit(limit)
+                         .subquery())
+        return (session.query(Player)
+                       .join(counts, counts.c.player_id == Player.id)
+                       .order_by(desc(counts.c.ngames))
+                       .all())
+
+    def games_version(self, session):
+        """
+        Summarize which games this player has, as (number of games, newest
+        game ID, when the newest one was loaded), to tell when their page has
+        changed.
+        """
+        return (session.query(func.count(Game.id), func.max(Game.id),
+                              Game.newest_load())
+                       .join(Game.players)
+                       .filter(GamePlayer.player_id == self.id)
+                       .filter(Game.nplayers >= 2)
+                       .one())
     
     def __repr__(self):
         return '<Player: {0}>'.format(self.name, self.iso_id)
@@ -113,7 +170,8 @@ class Player(Base, DataMixin):
         template = Template(
             '<a href="/player/id/{{ player.iso_id_url }}" class="player">'
             '{{ player.name }}'
-            '</a>'
+            '</a>',
+            autoescape=True
         )
         return template.render(player=self)
 
@@ -128,15 +186,17 @@ class GamePlayer(Base, DataMixin):
     when a player has changed their name.
     """
     __tablename__ = 'game_players'
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
 
     # player_index: the identifier such as 'p0' or 'p1' that distinguishes the
     # player through most of the game log. I'm not sure that it actually has
     # anything to do with who took the first turn.
     player_index = Column(String)
 
-    # Link to the game, and to the player if the player is registered.
-    game_id = Column(Integer, ForeignKey('games.id'), index=True)
+    # Link to the game, and to the player if the player is registered. The
+    # game's timestamp is what this table is partitioned on.
+    game_id = Column(Integer, index=True)
+    game_timestamp = Column(DateTime, primary_key=True)
     player_id = Column(Integer, ForeignKey('players.id'), index=True,
                        nullable=True)
     
@@ -148,6 +208,11 @@ class GamePlayer(Base, DataMixin):
     
     jsondata = Column(String, default='{}')
 
+    __table_args__ = (
+        game_reference('game_id', 'game_timestamp'),
+        {'postgresql_partition_by': 'RANGE (game_timestamp)'},
+    )
+
     @staticmethod
     def from_parse_data(parsed, player_index, player_obj):
         info = parsed['players'][player_index]
@@ -166,9 +231,61 @@ class GamePlayer(Base, DataMixin):
         return '<GamePlayer: {} in game #{})>'.format(self.player_name, self.game_id)
 
 
+class GameCard(Base):
+    """
+    A card in a player's starting hand, normalized out of the JSON data so
+    that we can search for games by the cards they started with.
+    """
+    __tablename__ = 'game_cards'
+    id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, index=True)
+    game_timestamp = Column(DateTime)
+    player_id = Column(Integer, ForeignKey('players.id'), nullable=True)
+    card = Column(String)
+    player = relationship('Player')
+
+    __table_args__ = (
+        game_reference('game_id', 'game_timestamp'),
+        Index('ix_game_cards_card_game', 'card', 'game_id'),
+    )
+
+    def __repr__(self):
+        return '<GameCard: {} in game #{}>'.format(self.card, self.game_id)
+
+
+class GameAchievement(Base):
+    """
+    An achievement claimed by a player, normalized out of the JSON data so
+    that we can search for games by the achievements that were claimed.
+    """
+    __tablename__ = 'game_achievements'
+    id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, index=True)
+    game_timestamp = Column(DateTime)
+    player_id = Column(Integer, ForeignKey('players.id'), nullable=True)
+    achievement = Column(String)
+    player = relationship('Player')
+
+    __table_args__ = (
+        game_reference('game_id', 'game_timestamp'),
+        Index('ix_game_achievements_achievement_game',
+              'achievement', 'game_id'),
+    )
+
+    def __repr__(self):
+        return '<GameAchievement: {} in game #{}>'.format(self.achievement,
+                                                          self.game_id)
+
+
 class Game(Base, DataMixin):
+    """
+    A game that was played on Iso.
+
+    The games table is partitioned by month, so its primary key is
+    (id, timestamp). The ID alone is still unique.
+    """
     __tablename__ = 'games'
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
 
     # How many players were in the game?
     nplayers = Column(Integer)
@@ -176,11 +293,21 @@ class Game(Base, DataMixin):
     # Did it use the expansion?
     cardset = Column(String)
 
-    # What's the relative URL of the game log?
-    url = Column(String, index=True, unique=True)
+    # How was the game won? This is also in the JSON data, but we need it as
+    # a column to search on it.
+    win_condition = Column(String)
+
+    # What's the relative URL of the game log? The URL determines the
+    # timestamp, so it's unique along with the timestamp.
+    url = Column(String, index=True)
 
     # When was the game played?
-    timestamp = Column(DateTime, index=True)
+    timestamp = Column(DateTime, primary_key=True, index=True)
+
+    # When was it last loaded into the database? This is what tells us that
+    # a page has changed; a game that's loaded late can still have been
+    # played a long time ago.
+    loaded_at = Column(DateTime)
     
     # A one-to-many list of players in the game and information about them,
     # using GamePlayer objects.
@@ -189,10 +316,29 @@ class Game(Base, DataMixin):
                                      GamePlayer.player_index),
                            backref='game', cascade='all, delete-orphan')
 
+    # Starting cards and claimed achievements, for searching.
+    cards = relationship('GameCard', backref='game',
+                         cascade='all, delete-orphan')
+    achievements = relationship('GameAchievement', backref='game',
+                                cascade='all, delete-orphan')
+
     jsondata = Column(String, default='{}')
 
-    def friendly_timestamp(self):
-        datestr = dateutils.friendly_date(self.timestamp)
+    # Composite indexes for the common combinations of search filters. Every
+    # list of games is sorted by timestamp, so it goes last. Games with fewer
+    # than 2 players are never shown, so the partial index leaves them out.
+    __table_args__ = (
+        Index('ix_games_cardset_nplayers_timestamp',
+              'cardset', 'nplayers', 'timestamp'),
+        Index('ix_games_condition_timestamp', 'win_condition', 'timestamp'),
+        Index('ix_games_multiplayer_timestamp', 'timestamp', 'id',
+              postgresql_where=(nplayers >= 2)),
+        UniqueConstraint('url', 'timestamp', name='uq_games_url'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+    def friendly_timestamp(self, now=None):
+        datestr = dateutils.friendly_date(self.timestamp, now)
         timestr = dateutils.friendly_time(self.timestamp)
         return datestr + ', ' + timestr
     
@@ -206,16 +352,21 @@ class Game(Base, DataMixin):
 
     @staticmethod
     def get_by_url(session, url):
+        # The URL says when the game was played, so only one partition needs
+        # to be searched.
+        timestamp = dateutils.to_db(GameParser.url_timestamp(url))
         try:
-            found = session.query(Game).filter(Game.url == url).one()
+            found = (session.query(Game)
+                            .filter(Game.url == url)
+                            .filter(Game.timestamp == timestamp)
+                            .one())
             return found
         except NoResultFound:
             return None
 
     @staticmethod
     def games_on_day(session, timestamp):
-        day_start = dateutils.midnight_before(timestamp)
-        day_end = dateutils.midnight_after(timestamp)
+        day_start, day_end = dateutils.day_bounds(timestamp)
         results = (session.query(Game)
                           .filter(Game.timestamp >= day_start)
                           .filter(Game.timestamp < day_end)
@@ -223,13 +374,106 @@ class Game(Base, DataMixin):
                           .order_by(Game.timestamp))
         return results
 
+    @staticmethod
+    def newest_load():
+        """
+        An SQL expression for when the most recently loaded game in a query
+        was loaded. Games loaded before we kept track use their timestamp.
+        """
+        return func.max(func.coalesce(Game.loaded_at, Game.timestamp))
+
+    @staticmethod
+    def day_version(session, timestamp):
+        """
+        Summarize which games were played on a day, as (number of games,
+        newest game ID, when the newest one was loaded), to tell when its page
+        has changed.
+        """
+        day_start, day_end = dateutils.day_bounds(timestamp)
+        return (session.query(func.count(Game.id), func.max(Game.id),
+                              Game.newest_load())
+                       .filter(Game.timestamp >= day_start)
+                       .filter(Game.timestamp < day_end)
+                       .filter(Game.nplayers >= 2)
+                       .one())
+
+    @staticmethod
+    def search(session, win_condition=None, cardset=None, nplayers=None,
+               start=None, end=None, players=(), achievements=(), cards=(),
+               oldest_first=False, after=None, before=None):
+        """
+        Get a query for the games matching any combination of criteria.
+
+        `start` and `end` are datetimes bounding the timestamp, inclusive and
+        exclusive respectively. `players` is a list of Player objects,
+        `achievements` and `cards` are lists of names; a game has to match
+        all of each of them.
+
+        `after` and `before` are (timestamp, id) keys of games, for reading
+        the results a page at a time: only the games that come after or
+        before that game in the sort order are included. With `before`, the
+        games come in reverse order, starting with the one just before it.
+        """
+        results = session.query(Game).filter(Game.nplayers >= 2)
+        if win_condition is not None:
+            results = results.filter(Game.win_condition == win_condition)
+        if cardset is not None:
+            results = results.filter(Game.cardset == cardset)
+        if nplayers is not None:
+            results = results.filter(Game.nplayers == nplayers)
+        if start is not None:
+            results = results.filter(Game.timestamp >= dateutils.to_db(start))
+        if end is not None:
+            results = results.filter(Game.timestamp < dateutils.to_db(end))
+        for player in players:
+            results = results.filter(
+                Game.players.any(GamePlayer.player_id == player.id)
+            )
+        for achievement in achievements:
+            results = results.filter(
+                Game.achievements.any(GameAchievement.achievement == achievement)
+            )
+        for card in cards:
+            results = results.filter(Game.cards.any(GameCard.card == card))
+
+        key = tuple_(Game.timestamp, Game.id)
+        if after is not None:
+            after = tuple_(*after)
+            results = results.filter(key > after if oldest_first
+                                     else key < after)
+        if before is not None:
+            before = tuple_(*before)
+            results = results.filter(key < before if oldest_first
+                                     else key > before)
+            oldest_first = not oldest_first
+
+        if oldest_first:
+            return results.order_by(Game.timestamp, Game.id)
+        else:
+            return results.order_by(desc(Game.timestamp), desc(Game.id))
+
+    @staticmethod
+    def ensure_partition(session, timestamp):
+        """
+        Make sure that the monthly partitions exist for games played at
+        `timestamp`, a naive UTC datetime.
+        """
+        start = datetime(timestamp.year, timestamp.month, 1)
+        name = partition_name('games', start)
+        exists = session.execute(
+            text("SELECT to_regclass(:name)"), {'name': name}
+        ).scalar()
+        if exists is None:
+            create_partitions(session, start)
+
     @staticmethod
     def from_parse_data(parsed):
         game = Game(
             nplayers=parsed['nplayers'],
             url=parsed['url'],
-            timestamp=parsed['timestamp'],
-            cardset=parsed['cardset']
+            timestamp=dateutils.to_db(parsed['timestamp']),
+            cardset=parsed['cardset'],
+            win_condition=parsed['win_condition']
         )
         players = sorted(parsed['players'].items())
         game.data = {
@@ -246,37 +490,112 @@ class Game(Base, DataMixin):
             # all references to it
             game = existing
             LOG.warn('Found existing {}'.format(game))
+            old_kind = (game.win_condition, game.cardset)
+            old_counted = game.counted()
+            old_registered = game.registered_players()
             newgame = Game.from_parse_data(parsed)
             game.data = newgame.data
-            game.timestamp = newgame.timestamp.replace(tzinfo=None)
+            game.timestamp = newgame.timestamp
             game.nplayers = newgame.nplayers
             game.url = newgame.url
             game.cardset = newgame.cardset
+            game.win_condition = newgame.win_condition
         else:
             game = Game.from_parse_data(parsed)
+            Game.ensure_partition(session, game.timestamp)
+        game.loaded_at = datetime.utcnow()
 
-        players = []
-        for idx, playerdata in parsed['players'].items():
-            if playerdata['iso_id']:
-                player = Player.get_by_iso_id(session, playerdata['iso_id'])
-                if player is None:
-                    player = Player.from_parse_data(playerdata)
+        # Don't let the player lookups flush GamePlayers that aren't attached
+        # to the game yet; they don't have its ID and timestamp.
+        with session.no_autoflush:
+            players = []
+            for idx, playerdata in parsed['players'].items():
+                if playerdata['iso_id']:
+                    player = Player.get_by_iso_id(session,
+                                                  playerdata['iso_id'])
+                    if player is None:
+                        player = Player.from_parse_data(playerdata)
+                    else:
+                        player.name = playerdata['name']
+                    session.add(player)
                 else:
-                    player.name = playerdata['name']
-                session.add(player)
-            else:
-                player = None
+                    player = None
 
-            gp = GamePlayer.from_parse_data(parsed, idx, player)
-            players.append(gp)
-        
-        game.players = players
-        session.add(game)
+                gp = GamePlayer.from_parse_data(parsed, idx, player)
+                players.append(gp)
+
+            game.players = players
+            game.index_players(players)
+            session.add(game)
+        # Flush to get IDs for the new game and players.
+        session.flush()
+
+        # The URL determines the timestamp, so a reloaded game is still on
+        # the same day.
+        day = dateutils.pt_day(parsed['timestamp'])
+        if existing:
+            # A game that's being reloaded has already been counted, and its
+            # players, winners or win condition might have changed. Take back
+            # what it counted for before, then count it again.
+            HeadToHead.record_game(session, game.id, game.timestamp,
+                                   old_registered, delta=-1)
+            if old_counted:
+                DailySummary.record(session, day, *old_kind, delta=-1)
+        HeadToHead.record_game(session, game.id, game.timestamp,
+                               game.registered_players())
+        if game.counted():
+            DailySummary.record(session, day, game.win_condition,
+                                game.cardset)
         LOG.info("Added {}".format(game))
 
         if commit:
             session.commit()
 
+    def index_players(self, gameplayers):
+        """
+        Fill in the searchable starting cards and achievements of this game,
+        from the data on its GamePlayers.
+        """
+        cards = []
+        achievements = []
+        for gp in gameplayers:
+            data = gp.data
+            for card in data.get('cards', []):
+                cards.append(GameCard(card=card, player=gp.player))
+            for ach in data.get('achievements', []):
+                achievements.append(
+                    GameAchievement(achievement=ach, player=gp.player)
+                )
+        self.cards = cards
+        self.achievements = achievements
+
+    def as_dict(self):
+        "Get a JSON-serializable summary of this game, for the API."
+        return {
+            'id': self.id,
+            'url': self.url,
+            'timestamp': dateutils.to_pt(self.timestamp).isoformat(),
+            'nplayers': self.nplayers,
+            'cardset': self.cardset,
+            'win_condition': self.data['win_condition'],
+            'players': self.data['players']
+        }
+
+    def counted(self):
+        "Does this game count toward the daily summaries?"
+        return self.nplayers >= 2 and self.win_condition is not None
+
+    def registered_players(self):
+        """
+        Map the IDs of the registered players in this game to whether they
+        won. This is empty for a one-player game, which isn't a game against
+        anyone.
+        """
+        if self.nplayers < 2:
+            return {}
+        return {gp.player_id: gp.winner for gp in self.players
+                if gp.player_id is not None}
+
     def winners(self):
         return [player for player in self.data['players'] if player['winner']]
     
@@ -321,11 +640,13 @@ class Game(Base, DataMixin):
             template = Template(
                 '<a href="/player/id/{{ gplayer["iso_id_url"] }}" class="reg player">'
                 '{{ gplayer["name"] }}'
-                '</a>'
+                '</a>',
+                autoescape=True
             )
         else:
             template = Template(
-                '<span class="unreg player">{{ gplayer["name"] }}</span>'
+                '<span class="unreg player">{{ gplayer["name"] }}</span>',
+                autoescape=True
             )
         return template.render(gplayer=gplayer)
 
@@ -352,16 +673,640 @@ class Game(Base, DataMixin):
             '<span class="condition">{{ game.data.win_condition }}</span> '
             '{% if game.cardset != "base" %}'
             '<span class="cardset-name">{{ game.cardset.title() }}</span>'
-            '{% endif %}'
+            '{% endif %}',
+            autoescape=True
         )
         return template.render(game=self, playerdesc=playerdesc)
 
 
+class HeadToHead(Base):
+    """
+    A precomputed record of how two registered players have done against each
+    other.
+
+    Each pair is stored once, with the lower player ID as player A, so use
+    `HeadToHead.get` instead of querying for the pair directly.
+    """
+    __tablename__ = 'head_to_head'
+    player_a_id = Column(Integer, ForeignKey('players.id'), primary_key=True)
+    player_b_id = Column(Integer, ForeignKey('players.id'), primary_key=True,
+                         index=True)
+
+    # How many games they've played together, and how many times each one
+    # won while the other one lost.
+    games = Column(Integer, default=0)
+    a_wins = Column(Integer, default=0)
+    b_wins = Column(Integer, default=0)
+
+    # The most recent game they played together.
+    last_game_id = Column(Integer)
+    last_timestamp = Column(DateTime)
+
+    last_game = relationship('Game')
+
+    __table_args__ = (
+        game_reference('last_game_id', 'last_timestamp'),
+    )
+
+    @staticmethod
+    def pair_key(player1_id, player2_id):
+        return (min(player1_id, player2_id), max(player1_id, player2_id))
+
+    @staticmethod
+    def get(session, player1, player2):
+        return session.query(HeadToHead).get(
+            HeadToHead.pair_key(player1.id, player2.id)
+        )
+
+    def wins_for(self, player):
+        if player.id == self.player_a_id:
+            return self.a_wins
+        else:
+            return self.b_wins
+
+    def last_loaded(self, session):
+        "When was the most recently loaded of this pair's games loaded?"
+        return (self.games_query(session)
+                    .order_by(None)
+                    .with_entities(Game.newest_load())
+                    .scalar())
+
+    def games_query(self, session, after=None, before=None):
+        """
+        Get a query for the games this pair has played, most recent first,
+        read in order from the pair's (timestamp, game_id) index.
+
+        `after` and `before` are (timestamp, id) keys of games, as in
+        `Game.search`: with `before`, the games come in reverse order,
+        starting with the one just before it.
+        """
+        pair_game = HeadToHeadGame
+        query = (session.query(Game)
+                        .join(pair_game,
+                              and_(pair_game.game_id == Game.id,
+                                   pair_game.timestamp == Game.timestamp))
+                        .filter(pair_game.player_a_id == self.player_a_id)
+                        .filter(pair_game.player_b_id == self.player_b_id))
+        key = tuple_(HeadToHeadGame.timestamp, HeadToHeadGame.game_id)
+        if after is not None:
+            query = query.filter(key < tuple_(*after))
+        if before is not None:
+            return (query.filter(key > tuple_(*before))
+                         .order_by(HeadToHeadGame.timestamp,
+                                   HeadToHeadGame.game_id))
+        return query.order_by(desc(HeadToHeadGame.timestamp),
+                              desc(HeadToHeadGame.game_id))
+
+    @staticmethod
+    def record_game(session, game_id, timestamp, registered, delta=1):
+        """
+        Count a game in the head-to-head records of every pair of registered
+        players in it. `registered` maps their player IDs to whether they
+        won, as returned by `Game.registered_players`.
+
+        With `delta=-1`, this takes back a game that was counted before,
+        which is how a reloaded game is counted again.
+
+        Each record is changed with a single upsert or update, so that
+        loaders running at the same time don't lose each other's games.
+        """
+        for id1 in registered:
+            for id2 in registered:
+                if id1 >= id2:
+                    continue
+                a_won = registered[id1] and not registered[id2]
+                b_won = registered[id2] and not registered[id1]
+                if delta > 0:
+                    HeadToHead._add_game(session, id1, id2, game_id,
+                                         timestamp, int(a_won), int(b_won))
+                else:
+                    HeadToHead._remove_game(session, id1, id2, game_id,
+                                            int(a_won), int(b_won))
+
+    @staticmethod
+    def _add_game(session, id1, id2, game_id, timestamp, a_wins, b_wins):
+        table = HeadToHead.__table__
+        upsert = pg_insert(table).values(
+            player_a_id=id1, player_b_id=id2, games=1,
+            a_wins=a_wins, b_wins=b_wins,
+            last_game_id=game_id, last_timestamp=timestamp
+        )
+        newer = or_(table.c.last_timestamp.is_(None),
+                    table.c.last_timestamp <= upsert.excluded.last_timestamp)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['player_a_id', 'player_b_id'],
+            set_={
+                'games': table.c.games + 1,
+                'a_wins': table.c.a_wins + upsert.excluded.a_wins,
+                'b_wins': table.c.b_wins + upsert.excluded.b_wins,
+                'last_game_id': case(
+                    (newer, upsert.excluded.last_game_id),
+                    else_=table.c.last_game_id
+                ),
+                'last_timestamp': func.greatest(
+                    table.c.last_timestamp, upsert.excluded.last_timestamp
+                ),
+            }
+        )
+        session.execute(upsert)
+        session.execute(HeadToHeadGame.__table__.insert().values(
+            player_a_id=id1, player_b_id=id2,
+            game_id=game_id, timestamp=timestamp
+        ))
+
+    @staticmethod
+    def _remove_game(session, id1, id2, game_id, a_wins, b_wins):
+        params = {'a': id1, 'b': id2, 'game_id': game_id,
+                  'a_wins': a_wins, 'b_wins': b_wins}
+        for statement in FORGET_HEAD_TO_HEAD_GAME:
+            session.execute(text(statement), params)
+
+    def __repr__(self):
+        return '<HeadToHead: #{} vs. #{}, {}-{}>'.format(
+            self.player_a_id, self.player_b_id, self.a_wins, self.b_wins
+        )
+
+
+class HeadToHeadGame(Base):
+    """
+    An index of the games each pair of registered players has played
+    together, so that a page of their games can be read straight off the
+    (player_a_id, player_b_id, timestamp) index.
+    """
+    __tablename__ = 'head_to_head_games'
+    player_a_id = Column(Integer, ForeignKey('players.id'), primary_key=True)
+    player_b_id = Column(Integer, ForeignKey('players.id'), primary_key=True)
+    game_id = Column(Integer, primary_key=True, index=True)
+    timestamp = Column(DateTime)
+
+    __table_args__ = (
+        game_reference('game_id', 'timestamp'),
+        Index('ix_head_to_head_games_pair_timestamp',
+              'player_a_id', 'player_b_id', 'timestamp'),
+    )
+
+
+class DailySummary(Base):
+    """
+    A rollup of how many games were played on each day (in Pacific time),
+    broken down by win condition and cardset. It's kept up to date as games
+    are loaded, so that pages can show counts without scanning the games.
+
+    Like the game lists, this only counts games with at least 2 players.
+    """
+    __tablename__ = 'daily_summary'
+    day = Column(Date, primary_key=True)
+    win_condition = Column(String, primary_key=True)
+    cardset = Column(String, primary_key=True)
+    games = Column(Integer, default=0)
+
+    @staticmethod
+    def record(session, day, win_condition, cardset, delta=1):
+        """
+        Add `delta` to a count. This is a single upsert, so that loaders
+        running at the same time don't lose each other's updates.
+        """
+        table = DailySummary.__table__
+        upsert = pg_insert(table).values(
+            day=day, win_condition=win_condition, cardset=cardset,
+            games=delta
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['day', 'win_condition', 'cardset'],
+            set_={'games': table.c.games + upsert.excluded.games}
+        )
+        session.execute(upsert)
+
+    @staticmethod
+    def counts_by_day(session, first_day, last_day):
+        """
+        Get the summaries for a range of days, inclusive, as a dictionary
+        from each day to its total number of games and its number of games
+        for each win condition.
+        """
+        rows = (session.query(DailySummary)
+                       .filter(DailySummary.day >= first_day)
+                       .filter(DailySummary.day <= last_day))
+        counts = {}
+        for row in rows:
+            day = counts.setdefault(row.day, {'total': 0, 'conditions': {}})
+            day['total'] += row.games
+            conditions = day['conditions']
+            conditions[row.win_condition] = (
+                conditions.get(row.win_condition, 0) + row.games
+            )
+        return counts
+
+    def __repr__(self):
+        return '<DailySummary: {} {} {}: {}>'.format(
+            self.day, self.win_condition, self.cardset, self.games
+        )
+
+
+class IngestedFile(Base):
+    """
+    A checkpoint recording that a file in the data directory has been
+    ingested, so that restarting the ingest daemon doesn't load it again.
+    """
+    __tablename__ = 'ingested_files'
+    path = Column(String, primary_key=True)
+
+    # The modification time of the file when it was ingested, as a Unix
+    # timestamp, and when we ingested it.
+    mtime = Column(Integer)
+    ingested_at = Column(DateTime)
+
+    # False if the file couldn't be parsed or loaded. We don't retry those
+    # automatically; delete the row to try again.
+    ok = Column(Boolean, default=True)
+
+    @staticmethod
+    def known_paths(session, paths):
+        "Find which of a list of paths have already been ingested."
+        found = (session.query(IngestedFile.path)
+                        .filter(IngestedFile.path.in_(paths)))
+        return set(row.path for row in found)
+
+    def __repr__(self):
+        return '<IngestedFile: {}>'.format(self.path)
+
+
+# Rebuilding the head-to-head tables is one big aggregate in PostgreSQL,
+# instead of a round trip for every pair of players in every game.
+REBUILD_HEAD_TO_HEAD_GAMES = """
+INSERT INTO head_to_head_games (player_a_id, player_b_id, game_id, timestamp)
+SELECT DISTINCT a.player_id, b.player_id, g.id, g.timestamp
+FROM game_players a
+JOIN game_players b
+  ON a.game_id = b.game_id AND a.game_timestamp = b.game_timestamp
+  AND a.player_id < b.player_id
+JOIN games g ON g.id = a.game_id AND g.timestamp = a.game_timestamp
+WHERE g.nplayers >= 2
+"""
+
+# Take a game back out of a pair's head-to-head record. If it was their most
+# recent game, the one before it becomes the most recent, and a pair with no
+# games left has no record. These are separate statements, because drivers
+# that bind parameters on the server can't run several in one go.
+FORGET_HEAD_TO_HEAD_GAME = [
+    """
+    DELETE FROM head_to_head_games
+    WHERE player_a_id = :a AND player_b_id = :b AND game_id = :game_id
+    """,
+    """
+    UPDATE head_to_head
+    SET games = games - 1, a_wins = a_wins - :a_wins,
+        b_wins = b_wins - :b_wins
+    WHERE player_a_id = :a AND player_b_id = :b
+    """,
+    """
+    UPDATE head_to_head h
+    SET (last_game_id, last_timestamp) = (
+        SELECT hg.game_id, hg.timestamp FROM head_to_head_games hg
+        WHERE hg.player_a_id = :a AND hg.player_b_id = :b
+        ORDER BY hg.timestamp DESC, hg.game_id DESC
+        LIMIT 1
+    )
+    WHERE h.player_a_id = :a AND h.player_b_id = :b
+      AND h.last_game_id = :game_id
+    """,
+    """
+    DELETE FROM head_to_head
+    WHERE player_a_id = :a AND player_b_id = :b AND games <= 0
+    """,
+]
+
+REBUILD_HEAD_TO_HEAD = """
+INSERT INTO head_to_head
+  (player_a_id, player_b_id, games, a_wins, b_wins,
+   last_game_id, last_timestamp)
+SELECT a.player_id, b.player_id, count(*),
+  sum(CASE WHEN a.winner AND NOT b.winner THEN 1 ELSE 0 END),
+  sum(CASE WHEN b.winner AND NOT a.winner THEN 1 ELSE 0 END),
+  (array_agg(g.id ORDER BY g.timestamp DESC, g.id DESC))[1],
+  max(g.timestamp)
+FROM game_players a
+JOIN game_players b
+  ON a.game_id = b.game_id AND a.game_timestamp = b.game_timestamp
+  AND a.player_id < b.player_id
+JOIN games g ON g.id = a.game_id AND g.timestamp = a.game_timestamp
+WHERE g.nplayers >= 2
+GROUP BY a.player_id, b.player_id
+"""
+
+
+# Dates are in Pacific time, and naive timestamps in the database are in UTC,
+# as in `dateutils.pt_day`. The games counted are the ones `Game.counted`
+# accepts.
+REBUILD_DAILY_SUMMARY = """
+INSERT INTO daily_summary (day, win_condition, cardset, games)
+SELECT date(timestamp AT TIME ZONE 'UTC' AT TIME ZONE 'America/Los_Angeles')
+         AS day,
+       win_condition, cardset, count(*)
+FROM games
+WHERE nplayers >= 2 AND win_condition IS NOT NULL
+GROUP BY day, win_condition, cardset
+"""
+
+
+def rebuild_daily_summary():
+    """
+    Recompute the per-day rollups from scratch.
+    """
+    from scorepile.db import Session
+    session = Session()
+    session.query(DailySummary).delete()
+    session.execute(text(REBUILD_DAILY_SUMMARY))
+    session.commit()
+
+
+def rebuild_head_to_head():
+    """
+    Recompute all the head-to-head records from scratch.
+    """
+    from scorepile.db import Session
+    session = Session()
+    session.query(HeadToHeadGame).delete()
+    session.query(HeadToHead).delete()
+    session.execute(text(REBUILD_HEAD_TO_HEAD_GAMES))
+    session.execute(text(REBUILD_HEAD_TO_HEAD))
+    session.commit()
+
+
+def partition_name(table, start):
+    return '{}_y{:04d}m{:02d}'.format(table, start.year, start.month)
+
+
+def next_month(start):
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def create_partitions(session, start):
+    """
+    Create the partitions of the partitioned tables for the month beginning
+    at `start`, if they don't exist yet.
+    """
+    # Loaders running at the same time could both try to create a month's
+    # partitions, so take turns.
+    session.execute(text("SELECT pg_advisory_xact_lock(8093247)"))
+    end = next_month(start)
+    for table in PARTITIONED_TABLES:
+        session.execute(text(
+            "CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            "FOR VALUES FROM ('{start}') TO ('{end}')".format(
+                name=partition_name(table, start), table=table,
+                start=start.isoformat(' '), end=end.isoformat(' ')
+            )
+        ))
+
+
+def create_partitions_between(session, first, last):
+    "Create the monthly partitions for every month from `first` to `last`."
+    month = datetime(first.year, first.month, 1)
+    while month <= last:
+        create_partitions(session, month)
+        month = next_month(month)
+
+
+# Moving the games and the tables that refer to them from unpartitioned
+# tables to partitioned ones. The old tables are moved into the OLD_SCHEMA
+# schema, and the rows of COPIED_TABLES are copied back out of it. The
+# head-to-head tables are rebuilt instead of copied.
+#
+# A database from before any of this can be upgraded by running these
+# commands in order:
+#
+#   models.py partition     partition the games and their players
+#   models.py index         fill in win conditions, cards and achievements
+#   models.py utc           convert the timestamps to naive UTC
+#   models.py summary       count the games per day
+OLD_SCHEMA = 'scorepile_unpartitioned'
+MOVED_TABLES = ['head_to_head_games', 'head_to_head', 'game_cards',
+                'game_achievements', 'game_players', 'games']
+COPIED_TABLES = ['games', 'game_players', 'game_cards', 'game_achievements']
+
+
+def old_columns(session, table):
+    "Get the names of the columns of a table that has been moved aside."
+    return set(session.execute(text(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = :schema AND table_name = :table"
+    ), {'schema': OLD_SCHEMA, 'table': table}).scalars())
+
+
+def copy_to_partitions(session, table):
+    """
+    Copy the rows of a table that has been moved aside into its new table.
+    Columns that the old table didn't have yet are left NULL, and the
+    game's timestamp comes from the old games table.
+    """
+    existing = old_columns(session, table)
+    if not existing:
+        return
+    columns = [column.name for column in Base.metadata.tables[table].columns]
+    values = []
+    for column in columns:
+        if column == 'game_timestamp':
+            values.append('g.timestamp')
+        elif column in existing:
+            values.append('o.' + column)
+        else:
+            values.append('NULL')
+    statement = (
+        "INSERT INTO {table} ({columns}) "
+        "SELECT {values} FROM {old}.{table} o".format(
+            table=table, columns=', '.join(columns),
+            values=', '.join(values), old=OLD_SCHEMA
+        )
+    )
+    if table != 'games':
+        statement += " JOIN {old}.games g ON g.id = o.game_id".format(
+            old=OLD_SCHEMA
+        )
+    session.execute(text(statement))
+
+
+def partition_tables():
+    """
+    Convert a database made before the games were partitioned, including
+    one that doesn't have the search or head-to-head tables yet. The old
+    tables are moved aside, the new ones are created and filled from them,
+    and the head-to-head records are rebuilt. It all happens in one
+    transaction, so it either works or changes nothing.
+
+    This is the first step of upgrading an old database; see the commands
+    listed above OLD_SCHEMA for the rest.
+    """
+    from scorepile.db import Session
+    session = Session()
+    session.execute(text("CREATE SCHEMA {}".format(OLD_SCHEMA)))
+    for table in MOVED_TABLES:
+        # Indexes and sequences move along with the table, so their names
+        # are free for the new tables.
+        session.execute(text("ALTER TABLE IF EXISTS {} SET SCHEMA {}"
+                             .format(table, OLD_SCHEMA)))
+    Base.metadata.create_all(session.connection())
+
+    first, last = session.execute(text(
+        "SELECT min(timestamp), max(timestamp) FROM {}.games"
+        .format(OLD_SCHEMA)
+    )).one()
+    if first is not None:
+        create_partitions_between(session, first, last)
+    for table in COPIED_TABLES:
+        copy_to_partitions(session, table)
+    for table in COPIED_TABLES:
+        session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            "coalesce(max(id), 1)) FROM {table}".format(table=table)
+        ))
+    session.execute(text("DROP SCHEMA {} CASCADE".format(OLD_SCHEMA)))
+    session.execute(text(REBUILD_HEAD_TO_HEAD_GAMES))
+    session.execute(text(REBUILD_HEAD_TO_HEAD))
+    session.commit()
+
+
 def create_tables():
     from scorepile.db import ENGINE
     Base.metadata.create_all(ENGINE)
 
 
+def index_games(batch_size=1000):
+    """
+    Fill in the search columns and tables for games that were loaded before
+    they existed.
+
+    This goes through the games in order of ID, `batch_size` at a time, and
+    commits after each batch. Memory use stays flat, and if it's
+    interrupted, the games it finished stay indexed.
+    """
+    from scorepile.db import Session
+    session = Session()
+    last_id = 0
+    while True:
+        batch = (session.query(Game)
+                        .filter(Game.win_condition == None)
+                        .filter(Game.id > last_id)
+                        .order_by(Game.id)
+                        .limit(batch_size)
+                        .all())
+        if not batch:
+            break
+        for game in batch:
+            game.win_condition = game.data['win_condition']
+            game.index_players(game.players)
+            LOG.info("Indexed {}".format(game))
+        last_id = batch[-1].id
+        session.commit()
+        session.expunge_all()
+    session.close()
+
+
+# Moving a game to a different partition, one statement at a time: copy it
+# with its new timestamp, point everything that refers to it at the copy,
+# and delete the original.
+MOVE_GAME = [
+    """
+    INSERT INTO games ({columns})
+    SELECT {values} FROM games WHERE id = :id AND timestamp = :old
+    """,
+    """
+    UPDATE game_players SET game_timestamp = :new
+    WHERE game_id = :id AND game_timestamp = :old
+    """,
+    """
+    UPDATE game_cards SET game_timestamp = :new
+    WHERE game_id = :id AND game_timestamp = :old
+    """,
+    """
+    UPDATE game_achievements SET game_timestamp = :new
+    WHERE game_id = :id AND game_timestamp = :old
+    """,
+    """
+    UPDATE head_to_head_games SET timestamp = :new
+    WHERE game_id = :id AND timestamp = :old
+    """,
+    """
+    UPDATE head_to_head SET last_timestamp = :new
+    WHERE last_game_id = :id AND last_timestamp = :old
+    """,
+    """
+    DELETE FROM games WHERE id = :id AND timestamp = :old
+    """,
+]
+
+
+def move_game(session, game_id, old, new):
+    """
+    Change a game's timestamp to one in a different month.
+
+    Before PostgreSQL 15, updating a row so that it moves to another
+    partition deletes it and inserts it again, which trips the foreign keys
+    that refer to it instead of cascading. So the game is moved by hand.
+    """
+    columns = [column.name for column in Game.__table__.columns]
+    values = [':new' if column == 'timestamp' else column
+              for column in columns]
+    params = {'id': game_id, 'old': old, 'new': new}
+    for statement in MOVE_GAME:
+        session.execute(text(statement.format(
+            columns=', '.join(columns), values=', '.join(values)
+        )), params)
+
+
+def convert_timestamps(batch_size=1000):
+    """
+    Convert the timestamps of games that were stored before timestamps were
+    always stored as naive UTC. Some of them are in PT wall time, or in the
+    time zone of the server that loaded them.
+
+    Each game's timestamp is worked out again from its URL, which is where
+    it came from in the first place, so it's safe to run this more than
+    once. Within a month, the copies of the timestamp in other tables follow
+    it by ON UPDATE CASCADE; a game that changes months is moved with
+    `move_game`. It goes through the games `batch_size` at a time,
+    committing after each batch, and then rebuilds the per-day summaries
+    and the head-to-head records, whose days and orderings were computed
+    from the old timestamps.
+    """
+    from scorepile.db import Session
+    session = Session()
+    games = Game.__table__
+    last_id = 0
+    while True:
+        batch = (session.query(Game.id, Game.url, Game.timestamp)
+                        .filter(Game.id > last_id)
+                        .order_by(Game.id)
+                        .limit(batch_size)
+                        .all())
+        if not batch:
+            break
+        changed = 0
+        for game_id, url, timestamp in batch:
+            correct = dateutils.to_db(GameParser.url_timestamp(url))
+            if correct == timestamp:
+                continue
+            Game.ensure_partition(session, correct)
+            if (correct.year, correct.month) == (timestamp.year,
+                                                 timestamp.month):
+                session.execute(
+                    games.update()
+                         .where(games.c.id == game_id)
+                         .where(games.c.timestamp == timestamp)
+                         .values(timestamp=correct)
+                )
+            else:
+                move_game(session, game_id, timestamp, correct)
+            changed += 1
+        last_id = batch[-1].id
+        session.commit()
+        LOG.info("Converted {} timestamps, up to game #{}"
+                 .format(changed, last_id))
+    session.close()
+    rebuild_daily_summary()
+    rebuild_head_to_head()
+
+
 def delete_tables():
     from scorepile.db import ENGINE
     Base.metadata.drop_all(ENGINE)
@@ -379,6 +1324,17 @@ if __name__ == '__main__':
         create_tables()
     elif args.command == 'delete':
         delete_tables()
+    elif args.command == 'index':
+        index_games()
+    elif args.command == 'head_to_head':
+        rebuild_head_to_head()
+    elif args.command == 'summary':
+        rebuild_daily_summary()
+    elif args.command == 'partition':
+        partition_tables()
+    elif args.command == 'utc':
+        convert_timestamps()
     else:
-        print("Run 'models.py create' to create database tables.")
+        print("Run 'models.py create' to create database tables, or see "
+              "partition_tables to upgrade an old database.")
 
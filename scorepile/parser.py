@@ -2,7 +2,6 @@ from bs4 import BeautifulSoup
 from bs4.element import Tag, NavigableString
 import pytz
 import re
-import time
 from datetime import datetime
 from pprint import pprint
 from scorepile.dateutils import PT
@@ -43,9 +42,15 @@ class GameParser:
 
     @staticmethod
     def parse_time(timestr):
-        stime = time.strptime(timestr, '%Y%m%d-%H%M%S')
-        timestamp = datetime.fromtimestamp(time.mktime(stime), PT)
-        return timestamp
+        # The timestamps in game URLs are in PT, whatever time zone this
+        # server is in.
+        return PT.localize(datetime.strptime(timestr, '%Y%m%d-%H%M%S'))
+
+    @staticmethod
+    def url_timestamp(url):
+        "Get the time a game was played from the URL of its log."
+        timestr = '-'.join(url.split('-')[1:3])
+        return GameParser.parse_time(timestr)
 
     def handle_file(self, filename):
         file = open(filename)
@@ -53,8 +58,7 @@ class GameParser:
         url = sep + after
 
         # Extract the game's timestamp from the URL.
-        timestr = '-'.join(url.split('-')[1:3])
-        timestamp = GameParser.parse_time(timestr)
+        timestamp = GameParser.url_timestamp(url)
 
 
         for line in file:
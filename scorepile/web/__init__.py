@@ -1,18 +1,30 @@
-from bottle import route, abort
+from bottle import (route, abort, request, response, HTTPResponse,
+                    http_date, parse_date)
 from beaker.cache import CacheManager
 from beaker.util import parse_cache_config_options
 from datetime import datetime, timedelta
 import pytz
 from scorepile.db import Session
-from jinja2 import Environment, PackageLoader
-from scorepile.dateutils import full_date
+from jinja2 import Environment, PackageLoader, select_autoescape
+from scorepile.dateutils import full_date, day_key, day_bounds
+from scorepile.models import DailySummary
+from scorepile.web.assets import static_url, MANIFEST_PATH
+from urllib.parse import urlencode
+import calendar
+import hashlib
 import os
+import tempfile
+import time
 
 BASE_PATH = os.path.dirname(__file__) or '.'
-ENV = Environment(loader=PackageLoader('scorepile.web', 'templates'))
+ENV = Environment(loader=PackageLoader('scorepile.web', 'templates'),
+                  autoescape=select_autoescape(['html']))
+ENV.globals['static_url'] = static_url
 TEMPLATES = {
     'main_page': ENV.get_template('main_page.html'),
     'game_list': ENV.get_template('game_list.html'),
+    'game_search': ENV.get_template('game_search.html'),
+    'head_to_head': ENV.get_template('head_to_head.html'),
     'no_results': ENV.get_template('no_results.html')
 }
 PT = pytz.timezone('US/Pacific')
@@ -24,6 +36,50 @@ CACHE_OPTS = {
 }
 cache = CacheManager(**parse_cache_config_options(CACHE_OPTS))
 
+# Rendered game lists, for days (keyed by `day_key`) and for players (keyed
+# by iso_id). These are filled in as pages are sent, or ahead of time by the
+# `warm` command, and cleared by the ingest daemon when new games arrive.
+#
+# The pages themselves are files in PAGE_DIR, written and read a piece at a
+# time, so that a long list never has to be in memory all at once. The
+# caches hold the version of each page and the path to its file.
+PAGE_EXPIRE = 86400
+PAGE_CACHES = {
+    'day': cache.get_cache('games_by_day', expire=PAGE_EXPIRE),
+    'player': cache.get_cache('games_by_player', expire=PAGE_EXPIRE),
+}
+PAGE_DIR = BASE_PATH + '/cache/pages'
+PAGE_CHUNK_SIZE = 65536
+
+# How many rows to fetch from the server-side cursor at a time, and how many
+# template fragments to join together before sending them to the client.
+STREAM_ROWS = 100
+STREAM_BUFFER = 20
+
+# How many games to show on each page of a paginated list.
+PAGE_SIZE = 50
+
+
+def site_version():
+    """
+    Hash the templates and the static asset manifest, so that the ETags of
+    pages change when a new version of the site is deployed.
+    """
+    hasher = hashlib.md5()
+    paths = [BASE_PATH + '/templates/' + name
+             for name in sorted(os.listdir(BASE_PATH + '/templates'))]
+    paths.append(MANIFEST_PATH)
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                hasher.update(file.read())
+    return hasher.hexdigest()
+
+SITE_VERSION = site_version()
+
+# Pages can be cached briefly, then revalidated with their ETag.
+PAGE_CACHE = 'public, max-age=300'
+
 
 class MiniSession:
     """
@@ -40,16 +96,292 @@ class MiniSession:
         del self.session
 
 
+def page_key(subject, now):
+    """
+    Get the cache key for a page about `subject` that was rendered at `now`.
+    Pages say things like 'yesterday', so a page rendered on a different
+    day is a different page.
+    """
+    return '{}@{}'.format(subject, day_key(now))
+
+
+def page_path(kind, key, version):
+    """
+    Get the file to store a page in. Each version of a page gets its own
+    file, so a page being replaced can't be mixed up with the one replacing
+    it.
+    """
+    name = hashlib.md5(repr((key, version)).encode('utf-8')).hexdigest()
+    return os.path.join(PAGE_DIR, kind, name + '.html')
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_page(file):
+    try:
+        while True:
+            chunk = file.read(PAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        file.close()
+
+
+def cached_page(kind, subject, now, version):
+    """
+    Get the pieces of a page from PAGE_CACHES, or None if it isn't there.
+
+    Each page is cached along with the version of the data it was rendered
+    from, such as the result of `Game.day_version`. If the data has changed
+    since then, such as when `loader.py` has added games without clearing
+    the cache, the cached page is out of date and we return None.
+    """
+    try:
+        cached_version, path = PAGE_CACHES[kind].get_value(
+            page_key(subject, now)
+        )
+    except KeyError:
+        return None
+    if cached_version != version:
+        return None
+    try:
+        # Once the file is open, it can be read to the end even if it's
+        # replaced or removed in the meantime.
+        return read_page(open(path, encoding='utf-8'))
+    except FileNotFoundError:
+        return None
+
+
+def stream_and_cache(pieces, kind, subject, now, version):
+    """
+    Pass along the pieces of a page as they're generated, writing them to
+    the page's file as they go, and cache the page once they've all been
+    sent. If the client goes away partway through, nothing is cached.
+    """
+    key = page_key(subject, now)
+    path = page_path(kind, key, version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with open(fd, 'w', encoding='utf-8') as out:
+            for piece in pieces:
+                out.write(piece)
+                yield piece
+        os.replace(tmp_path, path)
+    finally:
+        remove_file(tmp_path)
+    try:
+        old_version, old_path = PAGE_CACHES[kind].get_value(key)
+    except KeyError:
+        old_path = None
+    PAGE_CACHES[kind].set_value(key, (version, path))
+    if old_path is not None and old_path != path:
+        remove_file(old_path)
+
+
+def cache_page(kind, subject, now, version, pieces):
+    "Render a page into the cache without sending it anywhere."
+    for piece in stream_and_cache(pieces, kind, subject, now, version):
+        pass
+
+
+def prune_pages(max_age=PAGE_EXPIRE):
+    """
+    Delete the files of pages that have expired, such as the ones rendered
+    on earlier days, which will never be looked up again.
+    """
+    cutoff = time.time() - max_age
+    for dirpath, dirnames, filenames in os.walk(PAGE_DIR):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def invalidate_pages(days=(), iso_ids=()):
+    """
+    Forget the cached pages for some days (as `day_key` strings) and some
+    players (by iso_id), because new games have been loaded for them.
+    """
+    now = datetime.now(PT)
+    keys = ([('day', page_key(day, now)) for day in days] +
+            [('player', page_key(iso_id, now)) for iso_id in iso_ids])
+    for kind, key in keys:
+        try:
+            version, path = PAGE_CACHES[kind].get_value(key)
+        except KeyError:
+            continue
+        PAGE_CACHES[kind].remove_value(key)
+        remove_file(path)
+
+
+def check_freshness(version, last_modified=None, now=None):
+    """
+    Set the ETag and Last-Modified headers for a page, and respond with
+    304 Not Modified if the client already has this version of it.
+
+    `version` is anything that changes when the page's data does, such as the
+    result of `Game.day_version`. The ETag also depends on the site version
+    and the current date in PT, because dates are shown as 'today',
+    'yesterday', and so on.
+
+    `last_modified` is when the page's newest data was loaded, as a naive
+    UTC datetime like the ones in the database. For the same reason as the
+    ETag, it's never earlier than the start of the current day in PT.
+    """
+    if now is None:
+        now = datetime.now(PT)
+    if last_modified is not None:
+        last_modified = max(last_modified, day_bounds(now)[0])
+    key = repr((SITE_VERSION, day_key(now), version)).encode('utf-8')
+    etag = 'W/"{}"'.format(hashlib.md5(key).hexdigest()[:16])
+    headers = {'ETag': etag, 'Cache-Control': PAGE_CACHE}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        not_modified = ('*' in tags or etag in tags or etag[2:] in tags)
+    elif if_modified_since is not None and last_modified is not None:
+        since = parse_date(if_modified_since)
+        not_modified = (
+            since is not None and
+            calendar.timegm(last_modified.timetuple()) <= since
+        )
+    else:
+        not_modified = False
+
+    if not_modified:
+        raise HTTPResponse(status=304, headers=headers)
+
+
+def server_side(query):
+    """
+    Make a query iterate over a server-side cursor, so that we only hold
+    STREAM_ROWS rows in memory at a time, no matter how many results there
+    are.
+    """
+    return query.execution_options(stream_results=True).yield_per(STREAM_ROWS)
+
+
+def stream_template(name, **context):
+    """
+    Render a template incrementally, returning an iterator over pieces of its
+    output. Bottle will send each piece as soon as it is generated.
+    """
+    stream = TEMPLATES[name].stream(**context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return stream
+
+
+def parse_int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# The query parameters that say which page of a list to show. 'page' is
+# from when lists were paged by number, and is dropped from links.
+PAGE_PARAMS = ('page', 'after', 'before')
+
+# How a game's timestamp appears in a page cursor.
+CURSOR_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+
+def game_cursor(game):
+    """
+    Identify a game's place in a list of games, as a string for the `after`
+    and `before` query parameters.
+    """
+    return '{}.{}'.format(game.timestamp.strftime(CURSOR_TIME_FORMAT), game.id)
+
+
+def parse_cursor(cursor):
+    "Get the (timestamp, id) key from a cursor, or None if it isn't one."
+    try:
+        timestr, idstr = cursor.split('.')
+        return datetime.strptime(timestr, CURSOR_TIME_FORMAT), int(idstr)
+    except (AttributeError, ValueError):
+        return None
+
+
+def cursor_page(params, page_size, get_query):
+    """
+    Get one page of a list of games, with the cursors for the pages before
+    and after it, if there are any.
+
+    `get_query(after, before)` should return a query for the games after or
+    before a (timestamp, id) key, as `Game.search` does. Pages are found
+    from the game on the edge of the neighboring page, not by counting from
+    the start, so the database can go straight to them on a (timestamp, id)
+    index however deep they are.
+    """
+    after = parse_cursor(params.get('after'))
+    before = parse_cursor(params.get('before'))
+    if before is not None:
+        after = None
+
+    # Ask for one extra game, to find out if there is another page.
+    games = get_query(after, before).limit(page_size + 1).all()
+    more = len(games) > page_size
+    games = games[:page_size]
+    if not games:
+        return [], None, None
+    if before is not None:
+        games.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = (after is not None), more
+    prev_cursor = game_cursor(games[0]) if has_prev else None
+    next_cursor = game_cursor(games[-1]) if has_next else None
+    return games, prev_cursor, next_cursor
+
+
+def page_url(path, params, **page):
+    """
+    Get the URL of another page of a paginated list, keeping the rest of the
+    query parameters the same. The keyword arguments say which page, such as
+    `page=2` or `after=cursor`.
+    """
+    items = [(key, value) for (key, value) in params.allitems()
+             if key not in PAGE_PARAMS and value]
+    items.extend(sorted(page.items()))
+    return path + '?' + urlencode(items)
+
+
 @route('/')
 def main_page():
     dates = []
     now = datetime.now(PT)
+    with MiniSession() as session:
+        first_day = (now - timedelta(days=7)).date()
+        last_day = (now - timedelta(days=1)).date()
+        counts = DailySummary.counts_by_day(session, first_day, last_day)
+
     for i in range(1, 8):
         backdate = now - timedelta(days=i)
+        summary = counts.get(backdate.date(), {'total': 0, 'conditions': {}})
         dates.append({
             'url': '/games/' + backdate.strftime('%Y/%m/%d'),
-            'title': full_date(backdate)
+            'title': full_date(backdate, now),
+            'games': summary['total'],
+            'conditions': sorted(summary['conditions'].items(),
+                                 key=lambda item: -item[1])
         })
 
+    check_freshness(('main_page', sorted(counts.items())), now=now)
     return TEMPLATES['main_page'].render(dates=dates)
-
@@ -0,0 +1,146 @@
+from bottle import route, request, static_file, abort
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_PATH = os.path.dirname(__file__) or '.'
+STATIC_DIR = BASE_PATH + '/static'
+
+# Built assets go in a subdirectory of the static directory. Each file is
+# copied there under its original name and under a name containing a hash of
+# its contents, along with precompressed versions of text files.
+DIST_DIR = STATIC_DIR + '/dist'
+MANIFEST_PATH = DIST_DIR + '/manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.txt', '.svg', '.ico', '.html')
+
+# Fingerprinted files never change, so browsers can keep them for a year.
+# Anything else might, so it only gets an hour.
+LONG_CACHE = 'public, max-age=31536000, immutable'
+SHORT_CACHE = 'public, max-age=3600'
+
+_manifest = None
+
+
+def fingerprinted_name(path, content):
+    digest = hashlib.md5(content).hexdigest()[:10]
+    base, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(base, digest, ext)
+
+
+def write_compressed(path, content):
+    with gzip.open(path + '.gz', 'wb', 9) as out:
+        out.write(content)
+    if brotli is not None:
+        with open(path + '.br', 'wb') as out:
+            out.write(brotli.compress(content))
+
+
+def build_assets():
+    """
+    Fingerprint and precompress everything in the static directory, and
+    write a manifest of the fingerprinted names for `static_url` to use.
+    This should be run once whenever the static files change.
+    """
+    if os.path.exists(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(STATIC_DIR):
+        if dirpath == STATIC_DIR:
+            dirnames.remove('dist')
+        dirnames.sort()
+        for filename in sorted(filenames):
+            fullpath = os.path.join(dirpath, filename)
+            path = os.path.relpath(fullpath, STATIC_DIR)
+            with open(fullpath, 'rb') as file:
+                content = file.read()
+
+            # Keep a copy under the original name too, so that relative URLs
+            # in stylesheets still work.
+            names = [path, fingerprinted_name(path, content)]
+            for name in names:
+                outpath = os.path.join(DIST_DIR, name)
+                os.makedirs(os.path.dirname(outpath), exist_ok=True)
+                with open(outpath, 'wb') as out:
+                    out.write(content)
+                if filename.endswith(COMPRESSIBLE):
+                    write_compressed(outpath, content)
+            manifest[path] = names[1]
+
+    with open(MANIFEST_PATH, 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+
+def load_manifest():
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST_PATH) as file:
+                _manifest = json.load(file)
+        except IOError:
+            _manifest = {}
+    return _manifest
+
+
+def static_url(path):
+    """
+    Get the URL of a static file, using its fingerprinted name if the assets
+    have been built.
+    """
+    fingerprinted = load_manifest().get(path)
+    if fingerprinted is None:
+        return '/static/' + path
+    return '/static/dist/' + fingerprinted
+
+
+def accepted_encodings():
+    accept = request.headers.get('Accept-Encoding', '')
+    return [coding.split(';')[0].strip() for coding in accept.split(',')]
+
+
+@route('/static/<path:path>')
+def serve_static(path):
+    """
+    Serve static files, for when the front-end server isn't doing it.
+    Prefers a precompressed copy when the browser accepts one.
+    """
+    if path.endswith(('.gz', '.br')):
+        abort(404)
+    fingerprinted = (path.startswith('dist/') and
+                     path[5:] in load_manifest().values())
+    mimetype = mimetypes.guess_type(path)[0] or 'auto'
+
+    result = None
+    encodings = accepted_encodings()
+    for encoding, suffix in [('br', '.br'), ('gzip', '.gz')]:
+        if encoding in encodings and os.path.exists(
+                os.path.join(STATIC_DIR, path + suffix)):
+            result = static_file(path + suffix, root=STATIC_DIR,
+                                 mimetype=mimetype)
+            # A range of the file (206) is a range of the compressed bytes,
+            # so it needs the header as much as the whole file does.
+            if 200 <= result.status_code < 300:
+                result.set_header('Content-Encoding', encoding)
+            break
+    if result is None:
+        result = static_file(path, root=STATIC_DIR, mimetype=mimetype)
+
+    result.set_header('Vary', 'Accept-Encoding')
+    if fingerprinted:
+        result.set_header('Cache-Control', LONG_CACHE)
+    else:
+        result.set_header('Cache-Control', SHORT_CACHE)
+    return result
+
+
+# This file can be run as a script from the command line.
+if __name__ == '__main__':
+    build_assets()
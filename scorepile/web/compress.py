@@ -0,0 +1,98 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSED_TYPES = ('text/html', 'application/json')
+
+
+class GzipEncoder:
+    def __init__(self):
+        # wbits=31 makes zlib write a gzip header and trailer.
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def process(self, chunk):
+        # Flush after every chunk, so that streamed pages still arrive a
+        # piece at a time.
+        return (self.compressor.compress(chunk) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self):
+        self.compressor = brotli.Compressor()
+
+    def process(self, chunk):
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def choose_encoder(environ):
+    accept = environ.get('HTTP_ACCEPT_ENCODING', '')
+    encodings = [coding.split(';')[0].strip() for coding in accept.split(',')]
+    if brotli is not None and 'br' in encodings:
+        return 'br', BrotliEncoder()
+    elif 'gzip' in encodings:
+        return 'gzip', GzipEncoder()
+    return None, None
+
+
+def compressed_body(body, encoder):
+    try:
+        for chunk in body:
+            if chunk:
+                yield encoder.process(chunk)
+        yield encoder.finish()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def compress(app):
+    """
+    WSGI middleware that compresses HTML and JSON responses with brotli or
+    gzip, whichever the client accepts. Responses that are already encoded,
+    such as precompressed static files, are passed through.
+
+    HEAD requests are passed through too. Their bodies are empty, and an
+    encoder would still write its header and trailer.
+    """
+    def compressed_app(environ, start_response):
+        encoding, encoder = choose_encoder(environ)
+        if encoder is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return app(environ, start_response)
+
+        state = {}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            names = dict((name.lower(), value) for (name, value) in headers)
+            content_type = names.get('content-type', '')
+            if (status.startswith('200') and
+                    content_type.startswith(COMPRESSED_TYPES) and
+                    'content-encoding' not in names):
+                state['compress'] = True
+                headers = [(name, value) for (name, value) in headers
+                           if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', encoding))
+                vary = names.get('vary')
+                headers = [(name, value) for (name, value) in headers
+                           if name.lower() != 'vary']
+                if vary:
+                    headers.append(('Vary', vary + ', Accept-Encoding'))
+                else:
+                    headers.append(('Vary', 'Accept-Encoding'))
+            return start_response(status, headers, exc_info)
+
+        body = app(environ, compressing_start_response)
+        if state.get('compress'):
+            return compressed_body(body, encoder)
+        return body
+
+    return compressed_app
@@ -1,8 +1,11 @@
 from bottle import route, abort, request
-from scorepile.web import PT, TEMPLATES, cache, MiniSession
+from scorepile.web import (PT, TEMPLATES, MiniSession, PAGE_SIZE,
+                           server_side, stream_template, page_url,
+                           cursor_page, check_freshness, cached_page,
+                           stream_and_cache)
 from datetime import datetime, timedelta
-from scorepile.models import Game, Player
-from scorepile.dateutils import friendly_date, full_date
+from scorepile.models import Game, Player, HeadToHead
+from scorepile.dateutils import full_date, day_key
 
 @route('/games')
 @route('/games/')
@@ -25,12 +28,44 @@ def game_list_interpret_date(year, month, day):
     return game_list_on_date(date)
 
 
-@cache.cache('games_by_day')
+def day_version(session, date):
+    """
+    Get the version of a day's data that its page depends on, ending with
+    when its newest game was loaded.
+    """
+    return tuple(Game.day_version(session, date))
+
+
+def day_page(session, date, now):
+    """
+    Render the list of games played on a given day, as an iterator over
+    pieces of the page.
+    """
+    title = "Games played {}".format(full_date(date, now))
+    games = server_side(Game.games_on_day(session, date))
+    return stream_template('game_list', title=title, games=games, now=now)
+
+
 def game_list_on_date(date):
-    title = "Games played {}".format(full_date(date))
+    """
+    Send the list of games played on a given day from the cache, or stream
+    it and cache it on the way out.
+
+    This is a generator, so the DB session stays open until the whole page
+    has been sent, and is closed when Bottle is done iterating over it.
+    """
+    now = datetime.now(PT)
     with MiniSession() as session:
-        games = Game.games_on_day(session, date).all()
-        return TEMPLATES['game_list'].render(title=title, games=games)
+        # Bottle turns a 304 raised here, before the first chunk, into the
+        # response.
+        version = day_version(session, date)
+        check_freshness(version, version[-1], now)
+        page = cached_page('day', day_key(date), now, version)
+        if page is not None:
+            yield from page
+        else:
+            yield from stream_and_cache(day_page(session, date, now),
+                                        'day', day_key(date), now, version)
 
 
 @route('/player/id/<iso_id>')
@@ -43,6 +78,43 @@ def player_by_id(iso_id):
             return game_list_for_player(player)
 
 
+@route('/player/id/<iso_id>/vs/<opponent_iso_id>')
+def player_vs_player(iso_id, opponent_iso_id):
+    with MiniSession() as session:
+        player = Player.get_by_iso_id(session, iso_id)
+        opponent = Player.get_by_iso_id(session, opponent_iso_id)
+        if player is None or opponent is None:
+            abort(404)
+        record = HeadToHead.get(session, player, opponent)
+        if record is None:
+            abort(404)
+        last_loaded = record.last_loaded(session)
+        check_freshness((player.name, opponent.name, record.games,
+                         record.last_game_id, last_loaded,
+                         request.query_string),
+                        last_loaded)
+
+        games, prev_cursor, next_cursor = cursor_page(
+            request.query, PAGE_SIZE,
+            lambda after, before: record.games_query(session, after, before)
+        )
+        path = request.path
+        prev_url = next_url = None
+        if prev_cursor:
+            prev_url = page_url(path, request.query, before=prev_cursor)
+        if next_cursor:
+            next_url = page_url(path, request.query, after=next_cursor)
+
+        title = "{} vs. {}".format(player.name, opponent.name)
+        return TEMPLATES['head_to_head'].render(
+            title=title, games=games, curplayer=player.iso_id,
+            now=datetime.now(PT),
+            player=player, opponent=opponent, record=record,
+            wins=record.wins_for(player), losses=record.wins_for(opponent),
+            prev_url=prev_url, next_url=next_url
+        )
+
+
 @route('/player/name/<name>')
 def player_by_name(name):
     with MiniSession() as session:
@@ -67,11 +139,39 @@ def player_search():
                 return game_list_for_player(player)
 
 
-@cache.cache('games_by_player', expire=3600)
-def game_list_for_player(player):
+def player_version(session, player):
+    """
+    Get the version of a player's data that their page depends on, ending
+    with when their newest game was loaded.
+    """
+    return (player.name,) + tuple(player.games_version(session))
+
+
+def player_page(session, player, now):
+    """
+    Render the list of games that a player has played, most recent first, as
+    an iterator over pieces of the page.
+    """
     title = "Player: {}".format(player.name)
+    games = server_side(player.played_games_query(session))
+    return stream_template('game_list', title=title, games=games,
+                           curplayer=player.iso_id, now=now)
+
+
+def game_list_for_player(player):
+    """
+    Send the list of games that a player has played from the cache, or
+    stream it and cache it on the way out.
+    """
+    now = datetime.now(PT)
     with MiniSession() as session:
-        games = player.played_games(session)
-        return TEMPLATES['game_list'].render(title=title, games=games,
-        curplayer=player.iso_id)
+        version = player_version(session, player)
+        check_freshness(version, version[-1], now)
+        page = cached_page('player', player.iso_id, now, version)
+        if page is not None:
+            yield from page
+        else:
+            yield from stream_and_cache(player_page(session, player, now),
+                                        'player', player.iso_id, now,
+                                        version)
 
@@ -0,0 +1,100 @@
+from bottle import route, request
+from scorepile.web import (PT, TEMPLATES, MiniSession, PAGE_SIZE, parse_int,
+                           page_url, cursor_page)
+from datetime import datetime
+from scorepile.models import Game, Player
+from scorepile.dateutils import day_bounds
+
+MAX_PAGE_SIZE = 200
+
+
+def parse_date(datestr):
+    """
+    Interpret a 'YYYY-MM-DD' string as midnight Pacific time on that day.
+    """
+    try:
+        return PT.localize(datetime.strptime(datestr, '%Y-%m-%d'))
+    except ValueError:
+        return None
+
+
+def search_criteria(session, params):
+    """
+    Turn the query parameters of a search into arguments for `Game.search`.
+
+    Returns None if the search can't match anything, such as when it asks for
+    a player we've never heard of.
+    """
+    criteria = {
+        'win_condition': params.get('condition') or None,
+        'cardset': params.get('cardset') or None,
+        'nplayers': parse_int(params.get('nplayers')),
+        'achievements': [ach for ach in params.getall('achievement') if ach],
+        'cards': [card for card in params.getall('card') if card],
+        'oldest_first': (params.get('sort') == 'oldest')
+    }
+    if params.get('from'):
+        criteria['start'] = parse_date(params.get('from'))
+    if params.get('to'):
+        end = parse_date(params.get('to'))
+        if end is not None:
+            criteria['end'] = day_bounds(end)[1]
+
+    players = []
+    for name in params.getall('player'):
+        if name:
+            player = Player.get_by_name(session, name)
+            if player is None:
+                return None
+            players.append(player)
+    criteria['players'] = players
+    return criteria
+
+
+def search_page(session, params, page_size):
+    """
+    Get one page of search results, with the cursors for the pages before
+    and after it, if there are any.
+    """
+    criteria = search_criteria(session, params)
+    if criteria is None:
+        return [], None, None
+    return cursor_page(
+        params, page_size,
+        lambda after, before: Game.search(session, after=after,
+                                          before=before, **criteria)
+    )
+
+
+@route('/search/games')
+def game_search():
+    params = request.query
+    with MiniSession() as session:
+        games, prev_cursor, next_cursor = search_page(session, params,
+                                                      PAGE_SIZE)
+        prev_url = next_url = None
+        if prev_cursor:
+            prev_url = page_url('/search/games', params, before=prev_cursor)
+        if next_cursor:
+            next_url = page_url('/search/games', params, after=next_cursor)
+        return TEMPLATES['game_search'].render(
+            title='Search games', games=games, params=params,
+            now=datetime.now(PT),
+            prev_url=prev_url, next_url=next_url
+        )
+
+
+@route('/api/search/games')
+def game_search_api():
+    params = request.query
+    page_size = min(MAX_PAGE_SIZE,
+                    max(1, parse_int(params.get('limit'), PAGE_SIZE)))
+    with MiniSession() as session:
+        games, prev_cursor, next_cursor = search_page(session, params,
+                                                      page_size)
+        return {
+            'more': next_cursor is not None,
+            'next': next_cursor,
+            'prev': prev_cursor,
+            'games': [game.as_dict() for game in games]
+        }
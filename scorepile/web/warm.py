@@ -0,0 +1,54 @@
+from scorepile.web import PT, MiniSession, cache_page, prune_pages
+from scorepile.web.game_list import (day_page, player_page, day_version,
+                                     player_version)
+from scorepile.models import Player
+from scorepile.dateutils import day_key
+from datetime import datetime, timedelta
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+def warm(nplayers=50, ndays=7, active_days=30):
+    """
+    Render and cache the game lists that are most likely to be requested:
+    the last `ndays` days, and the `nplayers` players who have played the
+    most games in the last `active_days` days.
+
+    Everything shares one DB session and one idea of the current time, so
+    the pages are cached under exactly the keys that requests will look up.
+    Run this after ingesting new games. It also clears out the files of
+    pages that have expired.
+    """
+    prune_pages()
+    now = datetime.now(PT)
+    with MiniSession() as session:
+        for i in range(1, ndays + 1):
+            date = now - timedelta(days=i)
+            version = day_version(session, date)
+            cache_page('day', day_key(date), now, version,
+                       day_page(session, date, now))
+            LOG.info("Warmed games for {}".format(day_key(date)))
+
+        since = now - timedelta(days=active_days)
+        for player in Player.most_active(session, since, nplayers):
+            version = player_version(session, player)
+            cache_page('player', player.iso_id, now, version,
+                       player_page(session, player, now))
+            LOG.info("Warmed games for {}".format(player))
+
+
+# This file can be run as a script from the command line.
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Render and cache the most popular game lists.'
+    )
+    parser.add_argument('--players', type=int, default=50,
+                        help='how many of the most active players to warm')
+    parser.add_argument('--days', type=int, default=7,
+                        help='how many recent days to warm')
+    parser.add_argument('--active-days', type=int, default=30,
+                        help='how far back to look for active players')
+    args = parser.parse_args()
+    warm(args.players, args.days, args.active_days)